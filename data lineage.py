@@ -1,54 +1,181 @@
 import streamlit as st
+import io
 import os
-import sqlparse
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from graphviz import Digraph
+import xlsxwriter
 
-# Function to extract tables from SQL files
+# File reads release the GIL, so oversubscribe the CPUs for IO-bound parsing
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Default number of hops traced from the Gold table, bounding deep or cyclic repos
+DEFAULT_MAX_DEPTH = 30
+
+# SQL comments and string literals, removed before statements are split and
+# scanned so a quoted ";" or "--" cannot break a statement apart
+NOISE_PATTERN = re.compile(rb"--[^\n]*|/\*.*?\*/|'[^']*(?:''[^']*)*'", re.DOTALL)
+
+# Statements that are queries, optionally opening with a CTE or parenthesis
+SELECT_PATTERN = re.compile(rb"[(\s]*(?:SELECT|WITH)\b", re.IGNORECASE)
+
+# FROM/JOIN clause listing one or more comma-separated, optionally aliased tables
+TABLE_CLAUSE_PATTERN = re.compile(
+    rb"\b(?:FROM|JOIN)\s+((?:[A-Za-z_]\w*(?:\.\w+)*(?:\s+(?:AS\s+)?\w+)?\s*,\s*)*[A-Za-z_]\w*(?:\.\w+)*)",
+    re.IGNORECASE)
+
+# Innermost function-call arguments that are not a subquery, e.g. the
+# "YEAR FROM created_at" of EXTRACT(YEAR FROM created_at)
+CALL_PATTERN = re.compile(rb"\b\w+\((?![\s(]*(?:SELECT|WITH)\b)[^()]*\)", re.IGNORECASE)
+
+# Yield the table names in a statement's FROM/JOIN clauses, without aliases
+# or schema qualifiers
+def _clause_tables(stmt):
+    for clause in TABLE_CLAUSE_PATTERN.findall(stmt):
+        for item in clause.split(b","):
+            yield item.split()[0].rsplit(b".", 1)[-1].decode("ascii")
+
+# Replace a matched span with spaces of the same length, so offsets in the
+# blanked SQL still line up with the original text
+def _blank(match):
+    return b" " * len(match.group())
+
+# Blank function calls from the innermost out, so a FROM inside call
+# arguments such as EXTRACT, SUBSTRING or TRIM is not taken for a table
+def _blank_calls(sql):
+    sql, count = CALL_PATTERN.subn(_blank, sql)
+    while count:
+        sql, count = CALL_PATTERN.subn(_blank, sql)
+    return sql
+
+# Function to extract tables from raw SQL bytes
 def extract_tables(sql):
-    parsed = sqlparse.parse(sql)
     tables = set()
-    for stmt in parsed:
-        if stmt.get_type() == "SELECT":
-            from_seen = False
-            for token in stmt.tokens:
-                if from_seen and isinstance(token, (sqlparse.sql.IdentifierList, sqlparse.sql.Identifier)):
-                    tables.add(token.get_real_name())
-                if token.ttype is sqlparse.tokens.Keyword and token.value.upper() == "FROM":
-                    from_seen = True
+    for stmt in _blank_calls(NOISE_PATTERN.sub(b" ", sql)).split(b";"):
+        if SELECT_PATTERN.match(stmt):
+            tables.update(_clause_tables(stmt))
+    return tables
+
+# Parsed tables of each SQL file, keyed by path, with the mtime and size
+# the file had when it was read
+_parsed_files = {}
+
+# Read and parse a SQL file, re-reading it only when its mtime or size changed
+def _parse_file(file_path, mtime_ns, size):
+    cached = _parsed_files.get(file_path)
+    if cached is not None and cached[:2] == (mtime_ns, size):
+        return cached[2]
+    with open(file_path, 'rb') as f:
+        sql_content = f.read()
+    tables = extract_tables(sql_content)
+    _parsed_files[file_path] = (mtime_ns, size, tables)
     return tables
 
-# Parse all SQL files in the directory
+# Extract a single SQL file's tables, re-parsing only if it changed
+def _process_file(file_path):
+    try:
+        stat = os.stat(file_path)
+        return file_path, _parse_file(file_path, stat.st_mtime_ns, stat.st_size)
+    except OSError:  # Broken link or file removed since the walk
+        return file_path, None
+
+# Yield the paths of all SQL files under the directory, walking with
+# os.scandir so DirEntry's cached type information avoids extra stat calls
+def _sql_paths(directory):
+    stack = [directory]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue  # Skip unreadable directories, as os.walk does
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".sql"):
+                    yield entry.path
+
+# Parse all SQL files in the directory, forgetting files no longer in it
 def parse_repo(directory):
     table_map = {}
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".sql"):
-                with open(os.path.join(root, file), 'r') as f:
-                    sql_content = f.read()
-                    tables = extract_tables(sql_content)
-                    table_map[file] = tables
+    parsed_paths = set()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for file_path, tables in executor.map(_process_file, _sql_paths(directory)):
+            if tables is not None:
+                table_map[os.path.basename(file_path)] = tables
+                parsed_paths.add(file_path)
+    for file_path in _parsed_files.keys() - parsed_paths:
+        _parsed_files.pop(file_path, None)
     return table_map
 
-# Recursive function to trace lineage
-def trace_lineage(start_table, table_map, lineage=None):
-    if lineage is None:
-        lineage = {}
-    for file, tables in table_map.items():
-        if start_table in tables:
-            lineage[start_table] = tables
-            for table in tables:
-                if table != start_table:
-                    trace_lineage(table, table_map, lineage)
+# Build the lineage graph once, linking each table to every table that
+# appears alongside it in a parsed file
+def build_lineage_graph(table_map):
+    graph = {}
+    for tables in table_map.values():
+        for table in tables:
+            graph.setdefault(table, set()).update(tables)
+    return graph
+
+# Breadth-first lineage trace that expands each table only once, up to max_depth hops
+def trace_lineage(start_table, table_map, graph=None, max_depth=DEFAULT_MAX_DEPTH):
+    if graph is None:
+        graph = build_lineage_graph(table_map)
+    lineage = {}
+    visited = set()
+    queue = deque([(start_table, 0)])
+    while queue:
+        table, depth = queue.popleft()
+        if depth >= max_depth or table in visited:
+            continue
+        visited.add(table)
+        children = graph.get(table)
+        if children:
+            lineage[table] = children
+            queue.extend((child, depth + 1) for child in children - visited)
     return lineage
 
-# Visualize lineage using Graphviz
+# Fingerprint the repo by SQL file paths, mtimes and sizes, used as a cache
+# key; broken links and files removed during the walk are skipped
+def _repo_fingerprint(directory):
+    fingerprint = []
+    for path in _sql_paths(directory):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(fingerprint))
+
+# Parse the repo and build its graph once per fingerprint across reruns;
+# only recent fingerprints are kept, so edited repos do not pile up entries
+@st.cache_data(show_spinner=False, max_entries=2)
+def _parse_repo_cached(directory, fingerprint):
+    table_map = parse_repo(directory)
+    return table_map, build_lineage_graph(table_map)
+
+# Visualize lineage as Graphviz DOT source, streamed into one buffer
 def visualize_lineage(lineage):
-    dot = Digraph(comment="Table Lineage")
+    dot = io.StringIO()
+    dot.write("// Table Lineage\ndigraph {\n")
     for parent, children in lineage.items():
         for child in children:
-            dot.edge(child, parent)
-    return dot
+            dot.write(f'\t"{child}" -> "{parent}"\n')
+    dot.write("}\n")
+    return dot.getvalue()
+
+# Stream the report rows into in-memory Excel bytes with xlsxwriter's
+# constant_memory mode; rows are written in order because pandas writes
+# column by column
+def excel_report(df):
+    buffer = io.BytesIO()
+    with xlsxwriter.Workbook(buffer, {"constant_memory": True}) as workbook:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, df.columns)
+        for row, values in enumerate(df.itertuples(index=False), start=1):
+            worksheet.write_row(row, 0, values)
+    return buffer.getvalue()
 
 # Streamlit UI
 def main():
@@ -61,43 +188,50 @@ def main():
     # Button to parse repo
     if repo_path and st.button("Parse Repo"):
         with st.spinner("Parsing SQL files..."):
-            table_map = parse_repo(repo_path)
+            _parse_repo_cached(repo_path, _repo_fingerprint(repo_path))
+            st.session_state["parsed_repo_path"] = repo_path
             st.success("SQL files parsed successfully!")
+
+    if repo_path and st.session_state.get("parsed_repo_path") == repo_path:
+        fingerprint = _repo_fingerprint(repo_path)
+        table_map, table_graph = _parse_repo_cached(repo_path, fingerprint)
+
+        # Display parsed tables
+        st.write("### Parsed Tables:")
+        table_df = pd.DataFrame([(file, tables) for file, tables in table_map.items()],
+                                columns=["File Name", "Tables Found"])
+        st.dataframe(table_df)
+
+        # Input: Select Gold table
+        gold_table = st.text_input("Enter the Gold table to start lineage tracing:", "")
+        max_depth = st.number_input("Maximum lineage depth:", min_value=1, value=DEFAULT_MAX_DEPTH, step=1)
+
+        # Button to trace lineage
+        if gold_table and st.button("Trace Lineage"):
+            with st.spinner("Tracing lineage..."):
+                full_lineage = trace_lineage(gold_table, table_map, table_graph, max_depth)
+                lineage_df = pd.DataFrame.from_records(
+                    ((parent, child) for parent, children in full_lineage.items() for child in children),
+                    columns=["Parent Table", "Child Table"])
+                # Keep the result so later reruns redisplay it without retracing
+                st.session_state["traced_lineage"] = ((gold_table, max_depth, fingerprint), full_lineage, lineage_df, excel_report(lineage_df))
+                st.success("Lineage traced successfully!")
+
+        traced_lineage = st.session_state.get("traced_lineage")
+        if traced_lineage and traced_lineage[0] == (gold_table, max_depth, fingerprint):
+            _, full_lineage, lineage_df, report = traced_lineage
+
+            # Display lineage as a table
+            st.write("### Lineage Table:")
+            st.dataframe(lineage_df)
             
-            # Display parsed tables
-            st.write("### Parsed Tables:")
-            table_df = pd.DataFrame([(file, tables) for file, tables in table_map.items()],
-                                    columns=["File Name", "Tables Found"])
-            st.dataframe(table_df)
-
-            # Input: Select Gold table
-            gold_table = st.text_input("Enter the Gold table to start lineage tracing:", "")
-
-            # Button to trace lineage
-            if gold_table and st.button("Trace Lineage"):
-                with st.spinner("Tracing lineage..."):
-                    full_lineage = trace_lineage(gold_table, table_map)
-                    st.success("Lineage traced successfully!")
-                    
-                    # Display lineage as a table
-                    st.write("### Lineage Table:")
-                    lineage_data = []
-                    for parent, children in full_lineage.items():
-                        for child in children:
-                            lineage_data.append([parent, child])
-                    lineage_df = pd.DataFrame(lineage_data, columns=["Parent Table", "Child Table"])
-                    st.dataframe(lineage_df)
-                    
-                    # Visualize lineage
-                    st.write("### Lineage Visualization:")
-                    lineage_graph = visualize_lineage(full_lineage)
-                    st.graphviz_chart(lineage_graph.source)
-
-                    # Download lineage report
-                    st.write("### Download Report:")
-                    lineage_df.to_excel("lineage_report.xlsx", index=False)
-                    with open("lineage_report.xlsx", "rb") as file:
-                        st.download_button("Download Lineage Report", file, "lineage_report.xlsx")
+            # Visualize lineage
+            st.write("### Lineage Visualization:")
+            st.graphviz_chart(visualize_lineage(full_lineage))
+
+            # Download lineage report
+            st.write("### Download Report:")
+            st.download_button("Download Lineage Report", report, "lineage_report.xlsx")
 
 if __name__ == "__main__":
     main()
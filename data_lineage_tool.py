@@ -1,72 +1,213 @@
+import io
 import os
-import sqlparse
-from sqlparse.sql import IdentifierList, Identifier
-from sqlparse.tokens import Keyword
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from graphviz import Digraph
+import xlsxwriter
 import streamlit as st
 
-# Function to extract table names and logic from SQL content
+# File reads release the GIL, so oversubscribe the CPUs for IO-bound parsing
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Default number of hops traced from the Gold table, bounding deep or cyclic repos
+DEFAULT_MAX_DEPTH = 30
+
+# Identifiers mentioned in SQL content, including dotted schema.table names
+NAME_PATTERN = re.compile(rb"\w+(?:\.\w+)*")
+
+# SQL comments and string literals, blanked out before statements are split
+# and scanned so a quoted ";" or "--" cannot break a statement apart
+NOISE_PATTERN = re.compile(rb"--[^\n]*|/\*.*?\*/|'[^']*(?:''[^']*)*'", re.DOTALL)
+
+# One statement's extent, between semicolons
+STATEMENT_PATTERN = re.compile(rb"[^;]+")
+
+# Statements that are queries, optionally opening with a CTE or parenthesis
+SELECT_PATTERN = re.compile(rb"[(\s]*(?:SELECT|WITH)\b", re.IGNORECASE)
+
+# FROM/JOIN clause listing one or more comma-separated, optionally aliased tables
+TABLE_CLAUSE_PATTERN = re.compile(
+    rb"\b(?:FROM|JOIN)\s+((?:[A-Za-z_]\w*(?:\.\w+)*(?:\s+(?:AS\s+)?\w+)?\s*,\s*)*[A-Za-z_]\w*(?:\.\w+)*)",
+    re.IGNORECASE)
+
+# Innermost function-call arguments that are not a subquery, e.g. the
+# "YEAR FROM created_at" of EXTRACT(YEAR FROM created_at)
+CALL_PATTERN = re.compile(rb"\b\w+\((?![\s(]*(?:SELECT|WITH)\b)[^()]*\)", re.IGNORECASE)
+
+# Yield the table names in a statement's FROM/JOIN clauses, without aliases
+# or schema qualifiers
+def _clause_tables(stmt):
+    for clause in TABLE_CLAUSE_PATTERN.findall(stmt):
+        for item in clause.split(b","):
+            yield item.split()[0].rsplit(b".", 1)[-1].decode("ascii")
+
+# Replace a matched span with spaces of the same length, so offsets in the
+# blanked SQL still line up with the original text
+def _blank(match):
+    return b" " * len(match.group())
+
+# Blank function calls from the innermost out, so a FROM inside call
+# arguments such as EXTRACT, SUBSTRING or TRIM is not taken for a table
+def _blank_calls(sql):
+    sql, count = CALL_PATTERN.subn(_blank, sql)
+    while count:
+        sql, count = CALL_PATTERN.subn(_blank, sql)
+    return sql
+
+# Function to extract table names and logic from raw SQL bytes
 def extract_tables(sql_content):
-    parsed = sqlparse.parse(sql_content)
     tables = set()
     logic_snippets = []
 
-    for stmt in parsed:
-        if stmt.get_type() == "SELECT":
-            from_seen = False
-            logic_snippets.append(str(stmt).strip())  # Save query logic
-            for token in stmt.tokens:
-                if from_seen and isinstance(token, (IdentifierList, Identifier)):
-                    tables.add(token.get_real_name())
-                if token.ttype is Keyword and token.value.upper() == "FROM":
-                    from_seen = True
+    blanked = _blank_calls(NOISE_PATTERN.sub(_blank, sql_content))
+    for span in STATEMENT_PATTERN.finditer(blanked):
+        stmt = span.group()
+        if SELECT_PATTERN.match(stmt):
+            # Save query logic from the original text, literals included
+            logic_snippets.append(sql_content[span.start():span.end()].strip().decode("utf-8", "replace"))
+            tables.update(name.lower() for name in _clause_tables(stmt))
     return tables, logic_snippets
 
-# Search all SQL files for the target table
-def find_files_with_table(repo_path, target_table):
-    relevant_files = {}
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith(".sql"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read().lower()
-                    if target_table.lower() in content:
-                        tables, logic = extract_tables(content)
-                        relevant_files[file_path] = {"tables": tables, "logic": logic}
-    return relevant_files
-
-# Recursive function to trace lineage
-def trace_lineage(target_table, repo_path, lineage=None, visited_files=None):
-    if lineage is None:
-        lineage = {}
-    if visited_files is None:
-        visited_files = set()
-
-    relevant_files = find_files_with_table(repo_path, target_table)
-    for file_path, details in relevant_files.items():
-        if file_path in visited_files:
-            continue  # Avoid re-parsing the same file
-        visited_files.add(file_path)
-
-        if target_table not in lineage:
-            lineage[target_table] = []
-
-        for table in details["tables"]:
-            if table != target_table and table not in lineage[target_table]:
-                lineage[target_table].append((table, file_path, details["logic"]))
-                trace_lineage(table, repo_path, lineage, visited_files)
+# Parsed details of each SQL file, keyed by path, with the mtime and size
+# the file had when it was read
+_parsed_files = {}
+
+# Read and parse a SQL file, re-reading it only when its mtime or size changed
+def _parse_file(file_path, mtime_ns, size):
+    cached = _parsed_files.get(file_path)
+    if cached is not None and cached[:2] == (mtime_ns, size):
+        return cached[2]
+    with open(file_path, "rb") as f:
+        content = f.read()
+    tables, logic = extract_tables(content)
+    names = set()
+    for name in NAME_PATTERN.findall(content):
+        name = name.decode("ascii").lower()
+        names.add(name)
+        names.update(name.split("."))
+    details = {"tables": tables, "logic": logic, "names": names}
+    _parsed_files[file_path] = (mtime_ns, size, details)
+    return details
+
+# Extract a single SQL file's tables and logic, re-parsing only if it changed
+def _process_file(file_path):
+    try:
+        stat = os.stat(file_path)
+        return file_path, _parse_file(file_path, stat.st_mtime_ns, stat.st_size)
+    except OSError:  # Broken link or file removed since the walk
+        return file_path, None
+
+# Yield the paths of all SQL files under the directory, walking with
+# os.scandir so DirEntry's cached type information avoids extra stat calls
+def _sql_paths(directory):
+    stack = [directory]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue  # Skip unreadable directories, as os.walk does
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".sql"):
+                    yield entry.path
+
+# Parse every SQL file in the repo, forgetting files no longer in it
+def parse_repo(repo_path):
+    file_index = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for file_path, details in executor.map(_process_file, _sql_paths(repo_path)):
+            if details is not None:
+                file_index[file_path] = details
+    for file_path in _parsed_files.keys() - file_index.keys():
+        _parsed_files.pop(file_path, None)
+    return file_index
+
+# Build a reverse index mapping each mentioned name to the files containing it
+def build_table_index(file_index):
+    table_index = {}
+    for file_path, details in file_index.items():
+        for name in details["names"]:
+            table_index.setdefault(name, []).append(file_path)
+    return table_index
+
+# Breadth-first lineage trace that expands each table only once, up to max_depth hops
+def trace_lineage(target_table, file_index, table_index=None, max_depth=DEFAULT_MAX_DEPTH):
+    if table_index is None:
+        table_index = build_table_index(file_index)
+    lineage = {}
+    visited_tables = set()
+    visited_files = set()
+    queue = deque([(target_table, 0)])
+
+    while queue:
+        current, depth = queue.popleft()
+        if depth >= max_depth or current in visited_tables:
+            continue
+        visited_tables.add(current)
+
+        for file_path in table_index.get(current.lower(), ()):
+            if file_path in visited_files:
+                continue  # Avoid re-parsing the same file
+            visited_files.add(file_path)
+            details = file_index[file_path]
+
+            children = lineage.setdefault(current, [])
+            for table in details["tables"]:
+                if table != current:
+                    children.append((table, file_path, details["logic"]))
+                    if table not in visited_tables:
+                        queue.append((table, depth + 1))
 
     return lineage
 
-# Generate a visual lineage graph
+# Generate a visual lineage graph as Graphviz DOT source, streamed into one buffer
 def visualize_lineage(lineage):
-    dot = Digraph(comment="Full Table Lineage")
-    for parent, children in lineage.items():
-        for child, file_path, _ in children:
-            dot.edge(child, parent, label=os.path.basename(file_path))
-    return dot
+    # Emit each labelled edge once, even when several files repeat it
+    edges = dict.fromkeys((child, parent, os.path.basename(file_path).replace('"', '\\"'))
+                          for parent, children in lineage.items()
+                          for child, file_path, _ in children)
+    dot = io.StringIO()
+    dot.write("// Full Table Lineage\ndigraph {\n")
+    for child, parent, label in edges:
+        dot.write(f'\t"{child}" -> "{parent}" [label="{label}"]\n')
+    dot.write("}\n")
+    return dot.getvalue()
+
+# Stream the report rows into in-memory Excel bytes with xlsxwriter's
+# constant_memory mode; rows are written in order because pandas writes
+# column by column
+def excel_report(df):
+    buffer = io.BytesIO()
+    with xlsxwriter.Workbook(buffer, {"constant_memory": True}) as workbook:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, df.columns)
+        for row, values in enumerate(df.itertuples(index=False), start=1):
+            worksheet.write_row(row, 0, values)
+    return buffer.getvalue()
+
+# Fingerprint the repo by SQL file paths, mtimes and sizes, used as a cache
+# key; broken links and files removed during the walk are skipped
+def _repo_fingerprint(repo_path):
+    fingerprint = []
+    for path in _sql_paths(repo_path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(fingerprint))
+
+# Parse the repo and build its index once per fingerprint across reruns;
+# only recent fingerprints are kept, so edited repos do not pile up entries.
+# cache_resource returns the index without copying it, so the file details
+# are shared with _parsed_files rather than stored twice
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _parse_repo_cached(repo_path, fingerprint):
+    file_index = parse_repo(repo_path)
+    return file_index, build_table_index(file_index)
 
 # Streamlit UI
 def main():
@@ -76,33 +217,47 @@ def main():
     # User input
     repo_path = st.text_input("Enter the path to your SQL repo:", "")
     gold_table = st.text_input("Enter the Gold table name to trace lineage:", "")
+    max_depth = st.number_input("Maximum lineage depth:", min_value=1, value=DEFAULT_MAX_DEPTH, step=1)
+
+    if not (repo_path and gold_table):
+        return
 
-    if repo_path and gold_table and st.button("Trace Lineage"):
+    # The repo fingerprint is part of the key, so edited SQL invalidates a stored trace
+    fingerprint = _repo_fingerprint(repo_path)
+    trace_key = (repo_path, gold_table, max_depth, fingerprint)
+
+    if st.button("Trace Lineage"):
         with st.spinner("Tracing lineage across folders..."):
-            full_lineage = trace_lineage(gold_table, repo_path)
+            file_index, table_index = _parse_repo_cached(repo_path, fingerprint)
+            full_lineage = trace_lineage(gold_table, file_index, table_index, max_depth)
             if not full_lineage:
+                st.session_state.pop("traced_lineage", None)
                 st.error("No lineage found for the specified Gold table.")
                 return
 
             # Prepare lineage table for display
-            st.write("### Lineage Table:")
-            lineage_data = []
-            for parent, children in full_lineage.items():
-                for child, file, logic in children:
-                    lineage_data.append([parent, child, os.path.basename(file), "\n".join(logic[:2])])  # First 2 lines of logic
-            lineage_df = pd.DataFrame(lineage_data, columns=["Parent Table", "Child Table", "SQL File", "Logic Snippet"])
-            st.dataframe(lineage_df)
-
-            # Visualize lineage graph
-            st.write("### Lineage Visualization:")
-            lineage_graph = visualize_lineage(full_lineage)
-            st.graphviz_chart(lineage_graph.source)
-
-            # Download report
-            st.write("### Download Lineage Report:")
-            lineage_df.to_excel("cross_folder_lineage_report.xlsx", index=False)
-            with open("cross_folder_lineage_report.xlsx", "rb") as file:
-                st.download_button("Download Report", file, "cross_folder_lineage_report.xlsx")
+            lineage_df = pd.DataFrame.from_records(
+                ((parent, child, os.path.basename(file), "\n".join(logic[:2]))  # First 2 lines of logic
+                 for parent, children in full_lineage.items()
+                 for child, file, logic in children),
+                columns=["Parent Table", "Child Table", "SQL File", "Logic Snippet"])
+            # Keep the result so later reruns redisplay it without retracing
+            st.session_state["traced_lineage"] = (trace_key, full_lineage, lineage_df, excel_report(lineage_df))
+
+    traced_lineage = st.session_state.get("traced_lineage")
+    if traced_lineage and traced_lineage[0] == trace_key:
+        _, full_lineage, lineage_df, report = traced_lineage
+
+        st.write("### Lineage Table:")
+        st.dataframe(lineage_df)
+
+        # Visualize lineage graph
+        st.write("### Lineage Visualization:")
+        st.graphviz_chart(visualize_lineage(full_lineage))
+
+        # Download report
+        st.write("### Download Lineage Report:")
+        st.download_button("Download Report", report, "cross_folder_lineage_report.xlsx")
 
 if __name__ == "__main__":
     main()
@@ -1,77 +1,313 @@
+import io
+import itertools
+import mmap
 import os
+import pprint
 import re
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import networkx as nx
-from graphviz import Digraph
+from graphviz import ExecutableNotFound, Source
 
-# Function to scan SQL files and map table names to file paths
-def scan_sql_files(base_dir):
+# Directory walks and file reads release the GIL, so oversubscribe the CPUs
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Files at least this large are memory-mapped instead of read into the heap
+MMAP_MIN_SIZE = 4096
+
+# Directory holding the extracted SQL files
+SQL_BASE_DIR = "SQL/Extract"
+
+# Module written by `python lineage.py --precompute`, stored next to this script
+PRECOMPUTED_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_lineage_cache.py")
+
+# Maximum number of hierarchy lines rendered on screen
+HIERARCHY_PREVIEW_LINES = 500
+
+# Image formats the lineage graph can be exported as, with their MIME types
+GRAPH_MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+# SQL filenames of the form <prefix><group>_<table>.sql, e.g. s_sales_market_table.sql
+SQL_FILE_NAME_PATTERN = re.compile(r'(g_|s_|b_)(\w+?)_(.+)\.sql')
+
+# SQL comments and string literals, blanked out before references are matched
+SQL_NOISE_PATTERN = re.compile(rb"--[^\n]*|/\*.*?\*/|'[^']*(?:''[^']*)*'", re.DOTALL)
+
+# Referenced table names (e.g., g_table, s_table, b_table) in raw SQL bytes
+TABLE_REF_PATTERN = re.compile(rb'\b(?:g_|s_|b_)[a-z0-9_]+', re.IGNORECASE)
+
+# Function to walk a directory tree and yield its SQL files
+def iter_sql_files(base_dir):
     """
-    Scan the SQL file directory and map SQL-style table names to their file paths.
-    Handles the logic of descriptive names following prefixes like g_, s_, or b_.
+    Yield a DirEntry for every .sql file under base_dir.
+    Walks with os.scandir and an explicit stack so the cached DirEntry type
+    information replaces the extra stat calls and path joins of os.walk.
     """
-    table_file_map = {}
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            if file.endswith('.sql'):  # Process only .sql files
-                file_path = os.path.join(root, file)
-                file_lower = file.lower()  # Ensure case-insensitivity
-                match = re.match(r'(g_|s_|b_)(\w+?)_(.+)\.sql', file_lower)
-                if match:
-                    prefix = match.group(1)  # e.g., "s_"
-                    base_name = match.group(3)  # e.g., "market_table"
-                    sql_table_name = f"{prefix}{base_name}"
-                    table_file_map[sql_table_name] = file_path  # Map to full path
-    return table_file_map
+    stack = [base_dir]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:  # Skip unreadable directories, as os.walk does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.sql') and entry.is_file():  # Process only .sql files
+                    yield entry
 
 # Function to parse SQL content and extract referenced table names
 def extract_referenced_tables(sql_content):
     """
-    Extract referenced table names from SQL content using regex.
-    Handles aliases, subqueries, and nested references.
+    Extract referenced table names from raw SQL bytes using a precompiled regex.
+    Handles aliases, subqueries, and nested references, and ignores names that
+    only appear inside comments or string literals.
     """
-    # Regex to match table names (e.g., g_table, s_table, b_table)
-    matches = re.findall(r'\b(g_|s_|b_)[a-z0-9_]+', sql_content)
-    return set(matches)  # Return unique references
+    code = SQL_NOISE_PATTERN.sub(b' ', sql_content)
+    # Decode only the matched names, returning unique lowercase references
+    # interned so every occurrence of a table name shares one string object
+    return {sys.intern(match.group().decode('ascii').lower()) for match in TABLE_REF_PATTERN.finditer(code)}
 
-# Recursive function to build lineage of tables
-def build_lineage(table_name, table_file_map, visited):
+# Referenced tables of each SQL file read so far, keyed by path, with the
+# mtime and size the file had when it was read
+referenced_tables_cache = {}
+
+# Function to read a SQL file's referenced tables, cached per file version
+def read_referenced_tables(file_path, mtime_ns, size):
     """
-    Build the lineage of the selected table recursively by tracing dependencies.
-    Resolves references to corresponding SQL files and handles cyclic dependencies.
+    Read a SQL file and extract the tables it references.
+    The result is cached per path until the file's mtime or size changes, so
+    unchanged files are parsed once however many scans pass over them and
+    however large the tree is. Large files are scanned through a read-only
+    mmap, letting the kernel page them in without a copy.
     """
-    if table_name in visited:  # Avoid infinite loops for cyclic dependencies
-        return []
+    cached = referenced_tables_cache.get(file_path)
+    if cached is not None and cached[:2] == (mtime_ns, size):
+        return cached[2]
+    with open(file_path, 'rb') as f:
+        if size < MMAP_MIN_SIZE:  # Mapping overhead dominates for small files
+            refs = frozenset(extract_referenced_tables(f.read()))
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                refs = frozenset(extract_referenced_tables(mm))
+    referenced_tables_cache[file_path] = (mtime_ns, size, refs)
+    return refs
 
-    visited.add(table_name)  # Mark table as visited
-    file_path = table_file_map.get(table_name)
-    if not file_path:  # If the table file is not found, skip further processing
-        return []
+# Function to read the referenced tables of a directory entry
+def read_entry_tables(entry):
+    """
+    Extract the tables referenced by a SQL file entry, keyed on its stat
+    so the cached parse is reused while the file is unchanged.
+    """
+    stat = entry.stat()
+    return read_referenced_tables(entry.path, stat.st_mtime_ns, stat.st_size)
 
-    lineage = []
-    with open(file_path, 'r') as f:
-        content = f.read().lower()  # Normalize content to lowercase
-        # Extract referenced tables from the SQL content
-        referenced_tables = extract_referenced_tables(content)
+# Function to map SQL file entries to their table names and references
+def map_sql_tables(entries):
+    """
+    Map SQL-style table names to a (file path, referenced tables) pair for
+    the given SQL file entries, reading each matching file once.
+    Handles the logic of descriptive names following prefixes like g_, s_, or b_.
+    """
+    # Prefix (e.g. "s_") plus descriptive name (e.g. "market_table"), matched case-insensitively
+    return {
+        sys.intern(f"{match.group(1)}{match.group(3)}"): (entry.path, read_entry_tables(entry))
+        for entry in entries
+        if (match := SQL_FILE_NAME_PATTERN.match(entry.name.lower()))
+    }
+
+# Function to scan SQL files and map table names to file paths and references
+def scan_sql_files(base_dir):
+    """
+    Scan the SQL file directory and map SQL-style table names to their file
+    paths and the tables each file references.
+    Each top-level subdirectory is walked on its own worker thread and the
+    per-subtree maps are merged in directory order, and cached references of
+    files no longer in the tree are dropped. References are then
+    narrowed to the table names found in the scan, so the lineage graph only
+    contains tables that have a SQL file, and a file naming its own table
+    (e.g. in CREATE TABLE) does not count as a dependency on itself.
+    """
+    try:
+        with os.scandir(base_dir) as entries:
+            top_entries = list(entries)
+    except OSError:  # Missing or unreadable base directory
+        return {}
+
+    subdirs = [entry.path for entry in top_entries if entry.is_dir(follow_symlinks=False)]
+    table_info = map_sql_tables(entry for entry in top_entries
+                                if entry.name.endswith('.sql') and entry.is_file())
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for subtree_info in executor.map(lambda subdir: map_sql_tables(iter_sql_files(subdir)), subdirs):
+            table_info.update(subtree_info)
+    for path in referenced_tables_cache.keys() - {path for path, _ in table_info.values()}:
+        referenced_tables_cache.pop(path, None)  # Forget removed or renamed files
+    return {table: (path, refs.intersection(table_info) - {table}) for table, (path, refs) in table_info.items()}
+
+# Function to build lineage of tables breadth-first
+def build_lineage(table_name, table_info):
+    """
+    Build the lineage of the selected table by tracing dependencies breadth-first.
+    Uses the references collected by scan_sql_files, so no files are read here.
+    Tables are marked visited when queued, so each is queued and expanded at
+    most once however many parents reference it, and cycles terminate.
+    Returns an adjacency mapping of each parent table to its set of children;
+    the sets deduplicate edges repeated across references.
+    """
+    lineage = defaultdict(set)
+    visited = {table_name}  # Mark table as visited
+    queue = deque([table_name])
+    while queue:
+        current = queue.popleft()
+        # Tables without a SQL file have no references to follow
+        _, referenced_tables = table_info.get(current, (None, ()))
         for ref_table in referenced_tables:
-            if ref_table in table_file_map:
-                lineage.append((table_name, ref_table))  # Add relationship
-                # Recursively process referenced table
-                lineage.extend(build_lineage(ref_table, table_file_map, visited))
+            lineage[current].add(ref_table)  # Add relationship
+            if ref_table not in visited:  # Avoid infinite loops for cyclic dependencies
+                visited.add(ref_table)
+                queue.append(ref_table)  # Process referenced table later
     return lineage
 
+# Function to find dependency cycles in a lineage
+def find_cycles(lineage):
+    """
+    Find dependency cycles in the lineage adjacency mapping.
+    Runs an iterative depth-first search and returns the table path of each
+    back edge, e.g. ['s_a', 's_b', 's_a'], which usually points at SQL that
+    reads from one of its own downstream tables.
+    """
+    cycles = []
+    finished = set()
+    for root in list(lineage):
+        if root in finished:
+            continue
+        path = [root]
+        on_path = {root}
+        iterators = [iter(lineage.get(root, ()))]
+        while iterators:
+            child = next(iterators[-1], None)
+            if child is None:  # All children explored, backtrack
+                iterators.pop()
+                table = path.pop()
+                on_path.discard(table)
+                finished.add(table)
+            elif child in on_path:  # Back edge closes a cycle
+                cycles.append(path[path.index(child):] + [child])
+            elif child not in finished:
+                path.append(child)
+                on_path.add(child)
+                iterators.append(iter(lineage.get(child, ())))
+    return cycles
+
+# Function to fingerprint the SQL files in a tree for cache invalidation
+def tree_mtime_key(base_dir):
+    """
+    Return the path, modification time and size of every SQL file under base_dir.
+    Adding, removing, renaming or editing a SQL file anywhere in the tree
+    changes the key; files are only stat'ed, never read.
+    """
+    key = []
+    for entry in iter_sql_files(base_dir):
+        try:
+            stat = entry.stat()
+        except OSError:  # Skip files removed during the walk
+            continue
+        key.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(key))
+
+# Function to scan SQL files once per SQL tree fingerprint; only recent
+# fingerprints are kept, so file edits do not pile up cached scans
+@st.cache_data(show_spinner=False, max_entries=2)
+def scan_sql_files_cached(base_dir, tree_key):
+    """
+    Cached scan_sql_files, reused across Streamlit reruns until tree_key changes.
+    """
+    return scan_sql_files(base_dir)
+
+# Function to write the scanned table map out as a Python module
+def write_precomputed_table_info(base_dir, module_path=PRECOMPUTED_MODULE_PATH):
+    """
+    Scan base_dir and write the resulting table map to module_path as a
+    Python literal, stamped with the path, mtime and size of every SQL file it
+    was built from. Importing the module is much faster than scanning on a
+    cold start.
+    """
+    tree_key = tree_mtime_key(base_dir)
+    table_info = scan_sql_files(base_dir)
+    with open(module_path, "w") as f:
+        f.write("# Generated by `python lineage.py --precompute`; do not edit.\n")
+        f.write(f"TREE_KEY = {pprint.pformat(tree_key)}\n")
+        f.write(f"TABLE_INFO = {pprint.pformat(table_info)}\n")
+    return table_info
+
+# Function to load the precomputed table map if it matches the current tree
+def load_precomputed_table_info(tree_key):
+    """
+    Return TABLE_INFO from the precomputed module, or None if the module is
+    missing or any SQL file was added, removed or edited since it was built.
+    """
+    try:
+        import _lineage_cache
+    except ImportError:  # Not precomputed
+        return None
+    if _lineage_cache.TREE_KEY != tree_key:  # Stale, a SQL file has changed
+        return None
+    return _lineage_cache.TABLE_INFO
+
+# Function to get the table map, preferring the precomputed module
+def load_table_info(base_dir, tree_key):
+    """
+    Return the table map for base_dir from the precomputed module when it is
+    current, falling back to a cached live scan.
+    """
+    table_info = load_precomputed_table_info(tree_key)
+    if table_info is None:
+        table_info = scan_sql_files_cached(base_dir, tree_key)
+    return table_info
+
+# Function to build a table's lineage once per SQL tree fingerprint; the
+# most recently used lineages are kept, bounding tables times fingerprints
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_lineage_cached(selected_table, base_dir, tree_key):
+    """
+    Cached build_lineage, reused across Streamlit reruns until tree_key changes.
+    """
+    return build_lineage(selected_table, load_table_info(base_dir, tree_key))
+
+# Function to flatten the lineage adjacency into (parent, child) edges
+def iter_edges(lineage):
+    """
+    Yield each (parent, child) relationship in the lineage adjacency mapping.
+    """
+    for parent, children in lineage.items():
+        for child in children:
+            yield parent, child
+
 # Function to visualize the lineage as a directed graph using Graphviz
 def visualize_lineage(lineage):
     """
-    Create a directed graph to visualize table lineage.
+    Create the DOT source of a directed graph to visualize table lineage.
+    Edges are streamed into a StringIO buffer rather than built through a
+    graphviz.Digraph, since Streamlit only needs the text.
+    """
+    dot = io.StringIO()
+    dot.write("digraph {\n")
+    for parent, child in iter_edges(lineage):
+        dot.write(f'\t"{parent}" -> "{child}"\n')  # Add an edge from parent to child
+    dot.write("}\n")
+    return dot.getvalue()
+
+# Function to render the lineage graph to image bytes
+def render_graph(graph_source, image_format):
+    """
+    Render DOT source to image bytes in memory with a single Graphviz call,
+    without writing the DOT file or image to disk.
     """
-    dot = Digraph(format="png")
-    for parent, child in lineage:
-        dot.edge(parent, child)  # Add an edge from parent to child
-    return dot
+    return Source(graph_source).pipe(format=image_format)
 
 # Function to log diagnostic information to a text file
-def log_diagnostics(base_dir, selected_table, lineage, table_file_map):
+def log_diagnostics(base_dir, selected_table, lineage, table_info):
     """
     Generate a diagnostics log file capturing base directory, selected table,
     table-to-file mappings, and the extracted lineage.
@@ -82,10 +318,10 @@ def log_diagnostics(base_dir, selected_table, lineage, table_file_map):
         log.write(f"Base Directory: {base_dir}\n")
         log.write(f"Selected Table: {selected_table}\n")
         log.write("\nTable File Map:\n")
-        for table, path in table_file_map.items():
+        for table, (path, _) in table_info.items():
             log.write(f"{table}: {path}\n")
         log.write("\nLineage:\n")
-        for parent, child in lineage:
+        for parent, child in iter_edges(lineage):
             log.write(f"{parent} -> {child}\n")
     return log_file
 
@@ -98,11 +334,12 @@ def main():
     st.title("Table Lineage Tracker")  # Application title
 
     # Define base directory for SQL files
-    base_dir = "SQL/Extract"
+    base_dir = SQL_BASE_DIR
 
-    # Scan directory and map table names to file paths
-    table_file_map = scan_sql_files(base_dir)
-    gold_tables = [t for t in table_file_map.keys() if t.startswith('g_')]  # Filter Gold tables
+    # Scan directory and map table names to file paths and references
+    tree_key = tree_mtime_key(base_dir)
+    table_info = load_table_info(base_dir, tree_key)
+    gold_tables = [t for t in table_info.keys() if t.startswith('g_')]  # Filter Gold tables
 
     # User selects a Gold table from a dropdown
     selected_table = st.selectbox("Select a Gold Table", gold_tables)
@@ -111,33 +348,57 @@ def main():
         st.write(f"Selected Table: {selected_table}")
 
         # Build lineage for the selected table
-        visited = set()  # Track visited nodes to avoid infinite recursion
-        lineage = build_lineage(selected_table, table_file_map, visited)
+        lineage = build_lineage_cached(selected_table, base_dir, tree_key)
+
+        # Warn about cyclic dependencies, which Graphviz draws as loops
+        cycles = find_cycles(lineage)
+        if cycles:
+            st.warning("Cyclic dependencies found: " + "; ".join(" -> ".join(cycle) for cycle in cycles))
 
         # Log diagnostics to a file
-        log_file = log_diagnostics(base_dir, selected_table, lineage, table_file_map)
+        log_file = log_diagnostics(base_dir, selected_table, lineage, table_info)
         st.info(f"Diagnostics log created: {log_file}")
 
         # Visualize the lineage graph
         st.subheader("Lineage Graph")
-        graph = visualize_lineage(lineage)
-        st.graphviz_chart(graph.source)  # Display graph in Streamlit
+        graph_source = visualize_lineage(lineage)
+        st.graphviz_chart(graph_source)  # Display graph in Streamlit
 
         # Display the lineage as a text-based hierarchy
         st.subheader("Text-Based Hierarchy")
-        hierarchy = "\n".join([f"{parent} -> {child}" for parent, child in lineage])
-        st.text(hierarchy)  # Show hierarchy as plain text
+        edge_count = sum(len(children) for children in lineage.values())
+        preview = itertools.islice(iter_edges(lineage), HIERARCHY_PREVIEW_LINES)
+        st.text("\n".join(f"{parent} -> {child}" for parent, child in preview))  # Show hierarchy as plain text
+        if edge_count > HIERARCHY_PREVIEW_LINES:
+            st.caption(f"Showing the first {HIERARCHY_PREVIEW_LINES} of {edge_count} relationships; export for the full hierarchy.")
 
         # Provide export options for the graph and hierarchy
         st.subheader("Export Options")
-        if st.button("Export Graph as PNG"):
-            graph.render("lineage_graph", format="png", cleanup=True)  # Save as PNG
-            st.success("Graph exported as lineage_graph.png")
+        # Render the image only on request; the chart above is drawn in the browser
+        image_format = st.selectbox("Graph image format", list(GRAPH_MIME_TYPES))
+        if st.button("Export Graph as Image"):
+            try:
+                st.session_state["graph_image"] = ((graph_source, image_format), render_graph(graph_source, image_format))
+            except ExecutableNotFound:  # Graphviz binaries are needed for image export
+                st.warning("Install Graphviz to export the graph as an image.")
+
+        graph_image = st.session_state.get("graph_image")
+        if graph_image and graph_image[0] == (graph_source, image_format):
+            st.download_button(f"Download Graph as {image_format.upper()}", graph_image[1],
+                               f"lineage_graph.{image_format}", GRAPH_MIME_TYPES[image_format])
 
         if st.button("Export Hierarchy as Text"):
-            with open("lineage_hierarchy.txt", "w") as f:
-                f.write(hierarchy)  # Save hierarchy as text
+            # Skip rewriting the file when it already holds this exact lineage
+            lineage_key = hash(frozenset(iter_edges(lineage)))
+            if st.session_state.get("exported_hierarchy") != lineage_key or not os.path.exists("lineage_hierarchy.txt"):
+                with open("lineage_hierarchy.txt", "w") as f:
+                    f.writelines(f"{parent} -> {child}\n" for parent, child in iter_edges(lineage))  # Save hierarchy as text
+                st.session_state["exported_hierarchy"] = lineage_key
             st.success("Hierarchy exported as lineage_hierarchy.txt")
 
 if __name__ == "__main__":
-    main()
+    if "--precompute" in sys.argv[1:]:
+        table_info = write_precomputed_table_info(SQL_BASE_DIR)
+        print(f"Wrote {len(table_info)} tables to {PRECOMPUTED_MODULE_PATH}")
+    else:
+        main()